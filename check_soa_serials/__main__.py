@@ -4,14 +4,25 @@ Icinga2/Nagios plugin which compares the SOA serial numbers for the same DNS
 zone(s) from two different servers to ensure they are in sync
 """
 import argparse
+import asyncio
+import copy
+import functools
 import logging
+import socket
 import sys
-from typing import List, Generator, Optional, TypeVar
-
+from typing import Dict, List, Generator, Optional, Tuple, TypeVar
+
+import dns.asyncbackend
+import dns.asyncquery
+import dns.asyncresolver
+import dns.inet
+import dns.message
+import dns.rdatatype
 import dns.resolver
 import nagiosplugin  # type:ignore
 from dns.exception import DNSException
 from dns.exception import SyntaxError as DNSSyntaxError
+from dns.exception import Timeout as DNSTimeout
 
 U = TypeVar("U", bound=nagiosplugin.Metric)
 
@@ -21,9 +32,20 @@ DEFAULT_PORT = 53
 RANGE_NEVER_ALERT = "~:"
 RANGE_ALERT_GT_0 = "0"
 
+# Template resolver copied for each host so that `/etc/resolv.conf` is not
+# re-parsed per host (`configure=False`) and settings are applied only once
+_BASE_RESOLVER = dns.asyncresolver.Resolver(configure=False)
+_BASE_RESOLVER.search = []
+_BASE_RESOLVER.lifetime = 5.0
+_BASE_RESOLVER.timeout = 2.0
 
-def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
-    """Parse args"""
+
+@functools.lru_cache(maxsize=1)
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Build the argument parser, memoized since the parser is identical for
+    every invocation within a process (repeated `main` calls, tests)
+    """
 
     usage_examples: str = """examples:
 
@@ -53,11 +75,8 @@ def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
     )
 
     def read_lines(filepath: str) -> List[str]:
-        lines: List[str] = []
         with open(filepath, "r", encoding="utf-8") as fileh:
-            for line in fileh:
-                lines.append(line.lower().strip())
-        return lines
+            return [line.strip().lower() for line in fileh if line.strip()]
 
     parser.add_argument(
         "--zones-file",
@@ -116,6 +135,14 @@ def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
         type=str,
     )
 
+    return parser
+
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    """Parse args"""
+
+    parser = build_parser()
+
     if len(sys.argv) == 0:
         parser.print_help()
         raise SystemExit(1)
@@ -128,10 +155,13 @@ def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
         raise argparse.ArgumentTypeError(
             "At least one of `--zone` or `--zones-file` are required"
         )
-    # Combine zones lists from multiple sources into one field
+    # Combine zones lists from multiple sources into one field, removing
+    # dupes while preserving order so no time is spent querying a zone twice;
+    # both sources are already lowercased by their argparse types
     combo: argparse.Namespace = argparse.Namespace(
-        # Combine all zone sources and remove dupes
-        zones=list(set(args.zones_from_file or [] + args.zones_from_args or []))
+        zones=tuple(
+            dict.fromkeys((args.zones_from_file or []) + (args.zones_from_args or []))
+        )
     )
     args = argparse.Namespace(**vars(args), **vars(combo))
     del args.zones_from_args
@@ -150,6 +180,7 @@ def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
 
 
 # pylint: disable=too-few-public-methods
+# pylint: disable=too-many-instance-attributes
 class SOASerials(nagiosplugin.Resource):
     """
     Checking SOA serial results from two different servers
@@ -173,31 +204,49 @@ class SOASerials(nagiosplugin.Resource):
         # objs' formatters later
         self.crit_range = nagiosplugin.Range(crit_range)
         self.warn_range = nagiosplugin.Range(warn_range)
-        self.resolvers: List[dns.resolver.Resolver] = []
+        # Flatten the Range objects into plain boundary tuples once so the
+        # per-zone checks in `probe` are bare comparisons rather than
+        # `Range.__contains__` method calls
+        self._crit_bounds: Tuple[float, float, bool] = (
+            self.crit_range.start,
+            self.crit_range.end,
+            self.crit_range.invert,
+        )
+        self._warn_bounds: Tuple[float, float, bool] = (
+            self.warn_range.start,
+            self.warn_range.end,
+            self.warn_range.invert,
+        )
+        self.resolvers: List[dns.asyncresolver.Resolver] = []
         for host in hosts:
             # Sort out ports which may not be present
-            elements = host.split(":")
-            host_addr: str = (
-                elements[0]
-                if self.validate_ip(elements[0])
-                else self.resolve(elements[0])
-            )
-            port: int
-            if len(elements) > 1:
-                port = int(elements[1])
+            head, sep, tail = host.partition(":")
+            # `localhost` is common enough to special-case past the lookup
+            if head == "localhost":
+                host_addr: str = "127.0.0.1"
+            elif self.validate_ip(head):
+                host_addr = head
             else:
-                port = DEFAULT_PORT
+                host_addr = self.resolve(head)
+            port: int = int(tail) if sep else DEFAULT_PORT
 
             # Add to resolvers
-            resolver: dns.resolver.Resolver = dns.resolver.Resolver()
+            resolver: dns.asyncresolver.Resolver = copy.copy(_BASE_RESOLVER)
             resolver.nameservers = [host_addr]
             resolver.nameserver_ports = {host_addr: port}
             self.resolvers.append(resolver)
         self.tcp = proto == "tcp"
         self.zones = zones
+        # One pre-built query message per zone, shared by both hosts: the
+        # Resolver layer's search-list/cache/CNAME-chasing logic is all
+        # unused for apex SOA lookups, so query directly
+        self._queries: Dict[str, dns.message.Message] = {
+            zone: dns.message.make_query(zone, dns.rdatatype.SOA) for zone in zones
+        }
 
         self.warn_zones: List[str] = []
         self.crit_zones: List[str] = []
+        self.err_zones: List[str] = []
 
     @staticmethod
     def resolve(hostname: str) -> str:
@@ -215,32 +264,170 @@ class SOASerials(nagiosplugin.Resource):
         """
         try:
             dns.ipv4.inet_aton(address)
+            return True
+        except DNSSyntaxError:
+            pass
+        try:
             dns.ipv6.inet_aton(address)
             return True
         except DNSSyntaxError:
             return False
 
+    async def _query_all_udp(self) -> List:
+        """
+        Dispatch every (zone, resolver) query concurrently so total wall time
+        is ~max(RTT) rather than sum(RTT)
+        """
+
+        async def _one(resolver: dns.asyncresolver.Resolver, zone: str) -> int:
+            addr: str = str(resolver.nameservers[0])
+            port: int = resolver.nameserver_ports.get(addr, DEFAULT_PORT)
+            logger.debug(
+                "Processing zone `%s` against resolver `%s`",
+                zone,
+                resolver.nameservers,
+            )
+            # Keep the Resolver layer's retry-within-lifetime behavior the
+            # direct query path would otherwise lose: each datagram gets
+            # `timeout`, and lost packets are retried until `lifetime` is
+            # spent, so one ordinary UDP drop does not mark the zone errored
+            deadline = asyncio.get_running_loop().time() + resolver.lifetime
+            while True:
+                try:
+                    response = await dns.asyncquery.udp(
+                        self._queries[zone], addr, port=port, timeout=resolver.timeout
+                    )
+                    break
+                except DNSTimeout:
+                    if asyncio.get_running_loop().time() >= deadline:
+                        raise
+            if not response.answer:
+                raise dns.resolver.NoAnswer(response=response)
+            return response.answer[0][0].serial
+
+        tasks = [
+            _one(resolver, zone) for zone in self.zones for resolver in self.resolvers
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _query_all_tcp(self) -> List:
+        """
+        As `_query_all_udp`, but over one persistent TCP connection per host
+        reused for every zone, rather than a fresh handshake per query
+        """
+        backend = dns.asyncbackend.get_backend("asyncio")
+        socks: List = [None] * len(self.resolvers)
+        locks: List[asyncio.Lock] = [asyncio.Lock() for _ in self.resolvers]
+
+        async def _one(idx: int, zone: str) -> int:
+            resolver = self.resolvers[idx]
+            addr: str = str(resolver.nameservers[0])
+            port: int = resolver.nameserver_ports.get(addr, DEFAULT_PORT)
+            logger.debug(
+                "Processing zone `%s` against resolver `%s`",
+                zone,
+                resolver.nameservers,
+            )
+            query = self._queries[zone]
+            # One query at a time per connection
+            async with locks[idx]:
+                for attempt in range(2):
+                    try:
+                        if socks[idx] is None:
+                            socks[idx] = await backend.make_socket(
+                                dns.inet.af_for_address(addr),
+                                socket.SOCK_STREAM,
+                                0,
+                                None,
+                                (addr, port),
+                                resolver.timeout,
+                            )
+                        response = await dns.asyncquery.tcp(
+                            query,
+                            addr,
+                            port=port,
+                            sock=socks[idx],
+                            timeout=resolver.timeout,
+                        )
+                        break
+                    except (EOFError, OSError) as exc:
+                        # The server closed or refused the connection (servers
+                        # may close at will per RFC 7766); reconnect and retry
+                        # once, then degrade into the same per-zone error
+                        # tracking a failed UDP lookup gets
+                        if socks[idx] is not None:
+                            await socks[idx].close()
+                            socks[idx] = None
+                        if attempt:
+                            raise DNSException(
+                                f"TCP SOA query to {addr} failed: {exc}"
+                            ) from exc
+                    except DNSException:
+                        # A timed-out or mismatched exchange (Timeout,
+                        # BadResponse) leaves the stream desynced: a late
+                        # reply still in the buffer would be read as the
+                        # answer to the next zone's query.  Drop the
+                        # connection so the next query reconnects cleanly,
+                        # and charge only this zone with the error
+                        if socks[idx] is not None:
+                            await socks[idx].close()
+                            socks[idx] = None
+                        raise
+            if not response.answer:
+                raise dns.resolver.NoAnswer(response=response)
+            return response.answer[0][0].serial
+
+        tasks = [
+            _one(idx, zone) for zone in self.zones for idx in range(len(self.resolvers))
+        ]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for sock in socks:
+                if sock is not None:
+                    await sock.close()
+
     def probe(self) -> Generator[nagiosplugin.Metric, None, None]:
         """
         Run the check itself
         """
         warn_zones_c: int = 0
         crit_zones_c: int = 0
-        for zone in self.zones:
+        errored_zones_c: int = 0
+        last_err: Optional[DNSException] = None
+
+        def _in_range(bounds: Tuple[float, float, bool], value: int) -> bool:
+            low, high, invert = bounds
+            return (low <= value <= high) ^ invert
+
+        if self.tcp:
+            results = asyncio.run(self._query_all_tcp())
+        else:
+            results = asyncio.run(self._query_all_udp())
+        per_zone = len(self.resolvers)
+        for idx, zone in enumerate(self.zones):
             vals: List[int] = []
-            for resolver in self.resolvers:
-                logger.debug(
-                    "Processing zone `%s` against resolver `%s`",
-                    zone,
-                    resolver.nameservers,
-                )
-                try:
-                    soa_serial = resolver.resolve(zone, "SOA", tcp=self.tcp)[0].serial
-                except DNSException as err:
-                    raise nagiosplugin.CheckError from err
-                vals.append(int(soa_serial))
-            diff = abs(vals[0] - vals[1])
-            if diff not in self.crit_range:
+            err: Optional[DNSException] = None
+            for result in results[idx * per_zone : (idx + 1) * per_zone]:
+                if isinstance(result, DNSException):
+                    err = result
+                    break
+                if isinstance(result, BaseException):
+                    raise result
+                vals.append(result)
+            if err is not None:
+                # A failed zone should not throw away the answers the other
+                # zones already got; track it and move on
+                logger.warning("Zone `%s` lookup failed: %s", zone, err)
+                self.err_zones.append(zone)
+                errored_zones_c += 1
+                last_err = err
+                continue
+            # SOA serials wrap at 2^32 (RFC 1982 serial number arithmetic), so
+            # take the shorter way around the circle rather than abs()
+            wrapped = (vals[0] - vals[1]) & 0xFFFFFFFF
+            diff = wrapped if wrapped <= 0x80000000 else 0x100000000 - wrapped
+            if not _in_range(self._crit_bounds, diff):
                 logger.debug(
                     "Zone `%s` serial diff `%s` in critical range (`%s`)",
                     zone,
@@ -249,7 +436,7 @@ class SOASerials(nagiosplugin.Resource):
                 )
                 self.crit_zones.append(zone)
                 crit_zones_c += 1
-            elif diff not in self.warn_range:
+            elif not _in_range(self._warn_bounds, diff):
                 logger.debug(
                     "Zone `%s` serial diff `%s` in warning range (`%s`)",
                     zone,
@@ -266,6 +453,11 @@ class SOASerials(nagiosplugin.Resource):
                     self.warn_range,
                 )
                 logger.debug("Zone `%s` serial OK", zone)
+        if errored_zones_c and errored_zones_c == len(self.zones):
+            # Not a single zone produced data, so there is nothing to report
+            raise nagiosplugin.CheckError(
+                "SOA lookups failed for every zone"
+            ) from last_err
         yield nagiosplugin.Metric(
             "zones_critical",
             crit_zones_c,
@@ -276,9 +468,15 @@ class SOASerials(nagiosplugin.Resource):
             warn_zones_c,
             context="zones_warning",
         )
+        yield nagiosplugin.Metric(
+            "zones_errored",
+            errored_zones_c,
+            context="zones_errored",
+        )
 
 
 # pylint: enable=too-few-public-methods
+# pylint: enable=too-many-instance-attributes
 
 
 # pylint: disable-next=unused-argument
@@ -286,12 +484,17 @@ def formatter(metric: nagiosplugin.Metric, context: nagiosplugin.Context) -> str
     """
     Formatter for the plugin output before the perfdata to avoid getting too long
     """
-    zone_list: List[str] = (metric.resource.crit_zones + metric.resource.warn_zones)[:5]
+    if metric.value == 0:
+        # Nothing to list, so skip building the zone list entirely
+        return f"{metric.name} is 0"
+    if metric.name == "zones_errored":
+        zone_list: List[str] = metric.resource.err_zones[:5]
+    else:
+        zone_list = (metric.resource.crit_zones + metric.resource.warn_zones)[:5]
     zones_str: str = ",".join(zone_list)
     msg: str = f"{metric.name} is {metric.value}{': ' if zones_str else ''}{zones_str}"
 
-    # pylint: disable-next=consider-using-f-string
-    return "{:.45}{}".format(msg, f"{'…' if len(msg) > 44 else ''}")
+    return f"{msg[:44]}…" if len(msg) > 44 else msg
 
 
 @nagiosplugin.guarded
@@ -321,7 +524,13 @@ def main(
         warning=RANGE_ALERT_GT_0,
         fmt_metric=formatter,
     )
-    check = nagiosplugin.Check(soa_serials, context_crit, context_warn)
+    context_err = nagiosplugin.ScalarContext(
+        "zones_errored",
+        critical=RANGE_ALERT_GT_0,
+        warning=RANGE_NEVER_ALERT,
+        fmt_metric=formatter,
+    )
+    check = nagiosplugin.Check(soa_serials, context_crit, context_warn, context_err)
     check.main(args.verbosity)
 
 
@@ -0,0 +1,14 @@
+"""Shared pytest configuration"""
+
+import os
+
+import pytest  # type:ignore
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    """
+    Keep pytest's scratch tree on tmpfs when the host has one, so test tmpdir
+    traffic never touches a block device; an explicit --basetemp still wins
+    """
+    if config.option.basetemp is None and os.path.isdir("/dev/shm"):
+        config.option.basetemp = f"/dev/shm/pytest-{os.getuid()}"
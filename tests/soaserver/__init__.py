@@ -6,20 +6,18 @@ results consistently corresponding to the query for the purposes of testing
 
 Specific zones can be mapped to alternative results to simulate SOA serial drift
 """
+# The arg handling here deliberately mirrors `check_soa_serials.__main__`
+# pylint: disable=duplicate-code
 import argparse
+import functools
 import logging
 import multiprocessing
 import socket
+import struct
 import sys
+import threading
 from dataclasses import dataclass
-from typing import cast, Dict, Iterable, Optional, Tuple, Union
-from warnings import filterwarnings
-
-# pylint: disable=wrong-import-position
-filterwarnings("ignore", module="scapy")  # Just for testing it's fine
-from scapy.layers.dns import DNS, DNSRR  # type:ignore
-
-# pylint: enable=wrong-import-position
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 
 @dataclass
@@ -35,6 +33,37 @@ class SOAFields:
     minimum: int
 
 
+@functools.lru_cache(maxsize=4096)
+def encode_dns_name(name: str) -> bytes:
+    """
+    Encode a dotted name into DNS wire format, cached since the same names
+    recur for every request against a zone
+    """
+    buf = bytearray()
+    for part in name.split("."):
+        if not part:
+            continue
+        label = part.encode("ascii")
+        buf.append(len(label))
+        buf.extend(label)
+    buf.append(0)  # fin with null
+    return bytes(buf)
+
+
+@functools.lru_cache(maxsize=None)
+def _encode_soa_trailer(refresh: int, retry: int, expire: int, minimum: int) -> bytes:
+    """
+    The fixed tail of the SOA rdata; only the serial ever varies between
+    responses so this part is cached whole
+    """
+    return (
+        refresh.to_bytes(4, "big")
+        + retry.to_bytes(4, "big")
+        + expire.to_bytes(4, "big")
+        + minimum.to_bytes(4, "big")
+    )
+
+
 def _encode_soa_response(soa_fields: SOAFields) -> bytes:
     """
     Scapy encodes some `rdata` for some responses, but not for `SOA`! So we
@@ -104,90 +133,157 @@ def _encode_soa_response(soa_fields: SOAFields) -> bytes:
                     longer authoritative.
     """
 
-    def encode_dns_name(name: str) -> bytes:
-        encoded = b"".join(
-            bytes([len(part)]) + part.encode() for part in name.split(".") if part
-        )
-        return encoded + b"\x00"  # fin with null
-
     return (
         encode_dns_name(soa_fields.mname)
         + encode_dns_name(soa_fields.rname)
         + soa_fields.serial.to_bytes(4, "big")
-        + soa_fields.refresh.to_bytes(4, "big")
-        + soa_fields.retry.to_bytes(4, "big")
-        + soa_fields.expire.to_bytes(4, "big")
-        + soa_fields.minimum.to_bytes(4, "big")
+        + _encode_soa_trailer(
+            soa_fields.refresh,
+            soa_fields.retry,
+            soa_fields.expire,
+            soa_fields.minimum,
+        )
     )
 
 
-# pylint: disable=too-few-public-methods
-class SOAResponse:
+DEFAULT_SOA = 1507  # ZeroCool
+
+
+def parse_query(data: bytes) -> Tuple[int, str]:
     """
-    Return a `scapy.layers.dns.DNS` object with a direct SOA response to the
-    given query
+    Pull the transaction id and question name out of a DNS query without a
+    full packet parse; nothing else in the request matters to this server
     """
+    req_id: int = int.from_bytes(data[:2], "big")
+    labels: List[str] = []
+    i = 12
+    while data[i]:
+        length = data[i]
+        labels.append(data[i + 1 : i + 1 + length].decode())
+        i += 1 + length
+    return req_id, ".".join(labels) + "."
 
-    DEFAULT_SOA = 1507  # ZeroCool
 
-    def __new__(
-        cls, request: DNS = None, zone_soa_mappings: Optional[Dict[str, int]] = None
-    ) -> DNS:
-        """
-        `__new__` instead of making a subclass to avoid getting more complicated
-        with Typing
-        """
-        logging.info("Request: %s", request)
-        qname: str = request.qd.qname.decode()
-        # DNS names always end in `.` but user is not expected to provide the
-        # mapping that way
-        bare_qname = qname[:-1]
+# QR=1 (response), AA=1 (authoritative), RD=1, RA=1
+_RESPONSE_FLAGS = 0x8580
 
-        desired_soa: int
-        if zone_soa_mappings and zone_soa_mappings.get(bare_qname, None):
-            desired_soa = zone_soa_mappings[bare_qname]
-        else:
-            desired_soa = cls.DEFAULT_SOA
-
-        fields = SOAFields(
-            mname=f"dns.{qname}",
-            rname=f"postmaster.{qname}",
-            serial=desired_soa,
-            refresh=10800,
-            retry=3600,
-            expire=604800,
-            minimum=86400,
-        )
-        logging.info("SOA response: %s", fields)
-        rdata: bytes = _encode_soa_response(fields)
-        dnsrr: DNSRR = DNSRR(
-            rrname=qname,
-            type="SOA",
-            rdata=rdata,
-        )
-        return DNS(
-            id=request.id,  # must match request
-            qr=1,  # 0=query, 1=response
-            aa=1,  # authoritative=yes
-            an=dnsrr,
-            qd=request.qd,
-        )
+
+def bound_socket(host: str, port: int, socktype: int) -> socket.socket:
+    """
+    A socket bound with address reuse, so rebinding the same port in quick
+    succession does not race TIME_WAIT and the UDP/TCP pair can share a
+    port number cleanly
+    """
+    sock = socket.socket(socket.AF_INET, socktype)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
 
 
+def build_answerless_response(req_id: int, qname: str) -> bytes:
+    """
+    A NOERROR response that echoes the question but carries no answer
+    records, for simulating a server that cannot answer for a zone
+    """
+    header = struct.pack(">HHHHHH", req_id, _RESPONSE_FLAGS, 1, 0, 0, 0)
+    question = encode_dns_name(qname) + b"\x00\x06\x00\x01"
+    return header + question
+
+
+def build_soa_response(req_id: int, qname: str, serial: int) -> bytes:
+    """
+    Hand-roll the complete response in DNS wire format: 12-byte header,
+    question section, and one SOA answer. Scapy's layered packet build is by
+    far the slowest part of answering a query, and a direct SOA answer is the
+    only response this server ever sends.
+    """
+    fields = SOAFields(
+        mname=f"dns.{qname}",
+        rname=f"postmaster.{qname}",
+        serial=serial,
+        refresh=10800,
+        retry=3600,
+        expire=604800,
+        minimum=86400,
+    )
+    logging.info("SOA response: %s", fields)
+    rdata: bytes = _encode_soa_response(fields)
+    header = struct.pack(">HHHHHH", req_id, _RESPONSE_FLAGS, 1, 1, 0, 0)
+    # QTYPE=SOA, QCLASS=IN; the only question this server answers
+    question = encode_dns_name(qname) + b"\x00\x06\x00\x01"
+    # The answer names its owner via a compression pointer back to the qname
+    # at offset 12, then type/class/ttl/rdlength
+    answer = b"\xc0\x0c" + struct.pack(">HHIH", 6, 1, 0, len(rdata)) + rdata
+    return header + question + answer
+
+
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-arguments
+# pylint: disable=too-many-instance-attributes
 class BaseDNSServer:
     """Base"""
 
+    # How long a blocking socket call may go before checking `stop_event`
+    POLL_INTERVAL = 0.1
+
     def __init__(
         self,
         host: str = "localhost",
         port: int = 53,
-        zone_soa_mappings: Optional[Dict[str, int]] = None,
+        zone_soa_mappings: Optional[Dict[str, Optional[int]]] = None,
         request_history: Optional[list] = None,
+        stop_event: Optional[threading.Event] = None,
+        history_lock: Optional[threading.Lock] = None,
+        sock: Optional[socket.socket] = None,
     ):
         self.host = host
         self.port = port
+        # An already-bound socket may be handed in to skip the bind (and any
+        # bind race) in `run`
+        self.sock = sock
         self.zone_soa_mappings = zone_soa_mappings
         self.request_history = request_history if request_history is not None else []
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.history_lock = (
+            history_lock if history_lock is not None else threading.Lock()
+        )
+        self._resp_cache: Dict[Tuple[str, Optional[int]], bytes] = {}
+
+    def record_request(self, proto: str, qname: str) -> None:
+        """Append to the request history, which may be shared across servers"""
+        with self.history_lock:
+            self.request_history.append((proto, qname))
+
+    def respond(self, req_id: int, qname: str) -> bytes:
+        """
+        Return the raw response for a query, caching the full packet per
+        (qname, serial): only the transaction id differs between otherwise
+        identical responses, so patch it into the cached template.
+
+        A zone mapped to a serial of `None` gets an answerless NOERROR
+        response, to simulate a server that cannot answer for it
+        """
+        # DNS names always end in `.` but user is not expected to provide the
+        # mapping that way
+        bare_qname = qname[:-1]
+
+        serial: Optional[int]
+        if self.zone_soa_mappings and bare_qname in self.zone_soa_mappings:
+            serial = self.zone_soa_mappings[bare_qname]
+        else:
+            serial = DEFAULT_SOA
+
+        key = (qname, serial)
+        raw = self._resp_cache.get(key)
+        if raw is None:
+            if serial is None:
+                raw = build_answerless_response(req_id, qname)
+            else:
+                raw = build_soa_response(req_id, qname, serial)
+            self._resp_cache[key] = raw
+        return req_id.to_bytes(2, "big") + raw[2:]
 
     def run(self) -> None:
         """Must be implemented by subclass"""
@@ -200,29 +296,31 @@ class TCPDNSServer(BaseDNSServer):
     def run(self) -> None:
         """TCP Server"""
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind((self.host, self.port))
+        with (
+            self.sock
+            if self.sock is not None
+            else bound_socket(self.host, self.port, socket.SOCK_STREAM)
+        ) as sock:
             sock.listen()
-            while True:
-                conn, addr = sock.accept()
+            sock.settimeout(self.POLL_INTERVAL)
+            while not self.stop_event.is_set():
+                try:
+                    conn, addr = sock.accept()
+                # `socket.timeout` rather than `TimeoutError`: they are only
+                # the same class from Python 3.10 on
+                except socket.timeout:
+                    continue
                 logging.info("Connection from addr %s", addr)
                 with conn:
                     data: bytes = conn.recv(2048)
-                    request: DNS = DNS(
+                    try:
                         # Strip first two bytes which are the length field for
                         # DNS over TCP
-                        data[2:]
-                    )
-                    try:
-                        response = SOAResponse(
-                            request=request, zone_soa_mappings=self.zone_soa_mappings
-                        )
-                        logging.debug("Response: %s", response)
-                        raw_response = bytes(cast(bytes, response))
+                        req_id, qname = parse_query(data[2:])
+                        raw_response = self.respond(req_id, qname)
                         logging.debug("Raw Response: %s", raw_response)
-                        self.request_history.append(("tcp", request.qd.qname.decode()))
-                    except ValueError:
+                        self.record_request("tcp", qname)
+                    except (ValueError, IndexError):
                         continue
 
                     # For TCP DNS, prepend packet with data length
@@ -238,31 +336,41 @@ class UDPDNSServer(BaseDNSServer):
     """UDP listen/respond loop"""
 
     def run(self) -> None:
-        """TCP Server"""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((self.host, self.port))
+        """UDP Server"""
+        sock = (
+            self.sock
+            if self.sock is not None
+            else bound_socket(self.host, self.port, socket.SOCK_DGRAM)
+        )
+        sock.settimeout(self.POLL_INTERVAL)
 
-        while True:
-            data: bytes
+        # One receive buffer reused for every packet rather than a fresh
+        # bytes object per recvfrom
+        buf = bytearray(1024)
+        while not self.stop_event.is_set():
+            nbytes: int
             addr: Tuple[str, int]
-            data, addr = sock.recvfrom(1024)
+            try:
+                nbytes, addr = sock.recvfrom_into(buf, 1024)
+            # `socket.timeout` rather than `TimeoutError`: they are only the
+            # same class from Python 3.10 on
+            except socket.timeout:
+                continue
             logging.info("Packet from addr %s", addr)
-            request: DNS = DNS(data)
             try:
-                response = SOAResponse(
-                    request=request, zone_soa_mappings=self.zone_soa_mappings
-                )
-                logging.debug("Response: %s", response)
-                raw_response = bytes(cast(bytes, response))
+                req_id, qname = parse_query(bytes(buf[:nbytes]))
+                raw_response = self.respond(req_id, qname)
                 logging.debug("Raw Response: %s", raw_response)
-                self.request_history.append(("udp", request.qd.qname.decode()))
-            except ValueError:
+                self.record_request("udp", qname)
+            except (ValueError, IndexError):
                 continue
             logging.info("Sending response to %s", addr)
             sock.sendto(raw_response, addr)
 
 
 # pylint: enable=too-few-public-methods
+# pylint: enable=too-many-arguments
+# pylint: enable=too-many-instance-attributes
 
 
 def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
@@ -2,24 +2,16 @@
 
 import atexit
 import logging
-import multiprocessing
 import os
 import socket
 import tempfile
-from multiprocessing.managers import ListProxy
-from typing import Generator
-from warnings import filterwarnings
+import threading
+from typing import Generator, List, Tuple
 
 import pytest  # type:ignore
 
-# pylint: disable=wrong-import-position
-filterwarnings("ignore", module="scapy")  # Just for testing it's fine
-from scapy.layers.dns import DNS  # type:ignore
-
-# pylint: enable=wrong-import-position
-
 import check_soa_serials.__main__ as program  # type:ignore
-from tests.soaserver import TCPDNSServer, UDPDNSServer
+from tests.soaserver import bound_socket, TCPDNSServer, UDPDNSServer
 
 
 logger = logging.getLogger(__name__)
@@ -27,57 +19,100 @@ logger = logging.getLogger(__name__)
 SRV_HOST: str = "localhost"
 
 
-def unused_port() -> int:
-    """Get an open port"""
-    sock = socket.socket()
-    sock.bind(("", 0))
-    return sock.getsockname()[1]
+def bound_server_sockets() -> Tuple[int, socket.socket, socket.socket]:
+    """
+    Pick a free port by letting the kernel assign one to the TCP socket, then
+    bind its UDP mate to the same number.  Both sockets stay bound until the
+    servers take them over, so the port cannot be lost to another process in
+    between (the close-then-rebind race a bare port-probing helper has)
+    """
+    tcp_sock = bound_socket(SRV_HOST, 0, socket.SOCK_STREAM)
+    port: int = tcp_sock.getsockname()[1]
+    return port, tcp_sock, bound_socket(SRV_HOST, port, socket.SOCK_DGRAM)
 
 
-SRV_PORT_1: int = unused_port()
-SRV_PORT_2: int = unused_port()
+# Allocated at import time, which under pytest-xdist happens once per worker
+# process: every worker binds its own kernel-assigned ports, so parallel
+# workers cannot collide
+SRV_PORT_1, TCP_SOCK_1, UDP_SOCK_1 = bound_server_sockets()
+SRV_PORT_2, TCP_SOCK_2, UDP_SOCK_2 = bound_server_sockets()
 logger.debug("Found unused port for server #1: `%s`", SRV_PORT_1)
 logger.debug("Found unused port for server #2: `%s`", SRV_PORT_2)
 
 
-@pytest.fixture(name="request_history", scope="function")
-def fixture_request_history() -> ListProxy:
+@pytest.fixture(name="server_pool", scope="session")
+def fixture_server_pool() -> Generator:
     """
-    For new empty histories that the dummy servers (TCP, UDP) will fill with
-    the requests it receives
+    One TCP + one UDP server per port, started once and reused for the whole
+    session; each test just repoints the shared zone mappings and history
+    rather than paying server startup and teardown per case
     """
-    return multiprocessing.Manager().list()
+    stop_event = threading.Event()
+    threads: List[threading.Thread] = []
+    pool: dict = {}
+    for port, tcp_sock, udp_sock in (
+        (SRV_PORT_1, TCP_SOCK_1, UDP_SOCK_1),
+        (SRV_PORT_2, TCP_SOCK_2, UDP_SOCK_2),
+    ):
+        # The servers hold references to these, so mutating them in place
+        # between tests is visible without a restart
+        zone_soa_mappings: dict = {}
+        request_history: List[Tuple[str, str]] = []
+        history_lock = threading.Lock()
+        # The servers are I/O-bound loops, so threads are far cheaper to start
+        # and tear down than forked processes, and the history can be a plain
+        # list guarded by a lock.  The sockets were bound at import time, so
+        # the servers are queryable as soon as their threads start
+        logger.debug("Initializing SOA-only DNS servers on port `%s`", port)
+        tcp_server = TCPDNSServer(
+            host=SRV_HOST,
+            port=port,
+            zone_soa_mappings=zone_soa_mappings,
+            request_history=request_history,
+            stop_event=stop_event,
+            history_lock=history_lock,
+            sock=tcp_sock,
+        )
+        udp_server = UDPDNSServer(
+            host=SRV_HOST,
+            port=port,
+            zone_soa_mappings=zone_soa_mappings,
+            request_history=request_history,
+            stop_event=stop_event,
+            history_lock=history_lock,
+            sock=udp_sock,
+        )
+        # Listen before the thread even starts so the first TCP connect of
+        # the session cannot race the server thread's own listen() call
+        tcp_sock.listen()
+        for server in (tcp_server, udp_server):
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            threads.append(thread)
+        pool[port] = (zone_soa_mappings, request_history, history_lock)
+    yield pool
+    stop_event.set()
+    for thread in threads:
+        # Bound wait: a wedged server loop should fail the teardown loudly
+        # instead of hanging the whole session (the threads are daemonic, so
+        # they cannot block interpreter exit either way)
+        thread.join(timeout=2)
+        if thread.is_alive():
+            logger.warning("DNS server thread did not stop: %s", thread.name)
 
 
 @pytest.fixture(scope="function")
-def dummy_server(request: DNS, request_history: list) -> Generator:
+def dummy_server(request: pytest.FixtureRequest, server_pool: dict) -> Generator:
     """
     Respond to any queries with an SOA because that's all we are testing
     """
-    port = request.param["port"]
-    zone_soa_mappings = request.param.get("zone_soa_mappings", None)
-
-    logger.debug("Initializing SOA-only TCP DNS server on port `%s`", port)
-    tcp_server = TCPDNSServer(
-        host=SRV_HOST,
-        port=port,
-        zone_soa_mappings=zone_soa_mappings,
-        request_history=request_history,
-    )
-    logger.debug("Initializing SOA-only UDP DNS server on port `%s`", port)
-    udp_server = UDPDNSServer(
-        host=SRV_HOST,
-        port=port,
-        zone_soa_mappings=zone_soa_mappings,
-        request_history=request_history,
-    )
-    tcp_proc = multiprocessing.Process(target=tcp_server.run)
-    udp_proc = multiprocessing.Process(target=udp_server.run)
-    tcp_proc.start()
-    udp_proc.start()
+    port, mappings = request.param
+    zone_soa_mappings, request_history, history_lock = server_pool[port]
+    with history_lock:
+        zone_soa_mappings.clear()
+        zone_soa_mappings.update(dict(mappings or ()))
+        del request_history[:]
     yield request_history
-    tcp_proc.terminate()
-    udp_proc.terminate()
 
 
 def temp_zones_file() -> str:
@@ -105,215 +140,179 @@ dummy_server_1 = dummy_server
 dummy_server_2 = dummy_server
 
 
+# The host arguments are the same for every case, so format them once at
+# import instead of per test invocation
+COMMON_ARGS: Tuple[str, str] = (
+    f"localhost:{SRV_PORT_1}",
+    f"localhost:{SRV_PORT_2}",
+)
+
+
+# Server params are flat `(port, ((zone, serial), ...))` tuples rather than
+# nested dicts: small hashable params pickle cheaply when xdist ships them to
+# workers, and the host args (identical in every case) are appended inside the
+# test instead of being repeated here
 test_cases: list = [
     # <server 1 params>, <server 2 params>, <program args>, <expected results>
     (
         # OK with default thresholds
-        {
-            "port": SRV_PORT_1,
-        },
-        {
-            "port": SRV_PORT_2,
-        },
-        [
-            "--zone",
-            "domain.tld",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, None),
+        (SRV_PORT_2, None),
+        ("--zone", "domain.tld"),
         {
             "returncode": 0,
             "output": (
-                "SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
-                "zones_warning=0;0;~:"
+                b"SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
+                b"zones_errored=0;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain.tld."),
-            ],
         },
     ),
     (
         # CRIT with default thresholds
-        {
-            "port": SRV_PORT_1,
-            "zone_soa_mappings": {
-                "domain.tld": 1,
-            },
-        },
-        {
-            "port": SRV_PORT_2,
-            "zone_soa_mappings": {
-                "domain.tld": 5,
-            },
-        },
-        [
-            "--zone",
-            "domain.tld",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, (("domain.tld", 1),)),
+        (SRV_PORT_2, (("domain.tld", 5),)),
+        ("--zone", "domain.tld"),
         {
             "returncode": 2,
             "output": (
-                "SOASERIALS CRITICAL - zones_critical is 1: domain.tld (outside range "
-                "0:0) | zones_critical=1;~:;0 zones_warning=0;0;~:"
+                b"SOASERIALS CRITICAL - zones_critical is 1: domain.tld (outside range "
+                b"0:0) | zones_critical=1;~:;0 zones_errored=0;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain.tld."),
-            ],
         },
     ),
     (
         # OK with a higher threshold
-        {
-            "port": SRV_PORT_1,
-            "zone_soa_mappings": {
-                "domain.tld": 1,
-            },
-        },
-        {
-            "port": SRV_PORT_2,
-            "zone_soa_mappings": {
-                "domain.tld": 2,
-            },
-        },
-        [
-            "--zone",
-            "domain.tld",
-            # Crit if number of bad zones is outside -inf:inf which is
-            # impossible,  thus only WARN
-            "--critical=2",
-            "--warning=2",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, (("domain.tld", 1),)),
+        (SRV_PORT_2, (("domain.tld", 2),)),
+        ("--zone", "domain.tld", "--critical=2", "--warning=2"),
         {
             "returncode": 0,
             "output": (
-                "SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
-                "zones_warning=0;0;~:"
+                b"SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
+                b"zones_errored=0;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain.tld."),
-            ],
         },
     ),
     (
         # Warn (not CRIT) with a higher threshold
-        {
-            "port": SRV_PORT_1,
-            "zone_soa_mappings": {
-                "domain.tld": 1,
-            },
-        },
-        {
-            "port": SRV_PORT_2,
-            "zone_soa_mappings": {
-                "domain.tld": 9,
-            },
-        },
-        [
-            "--zone",
-            "domain.tld",
-            # Crit if number of bad zones is outside -inf:inf which is
-            # impossible,  thus only WARN
-            "--critical=~:",
-            "--warning=3",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, (("domain.tld", 1),)),
+        (SRV_PORT_2, (("domain.tld", 9),)),
+        # Crit if number of bad zones is outside -inf:inf which is
+        # impossible,  thus only WARN
+        ("--zone", "domain.tld", "--critical=~:", "--warning=3"),
         {
             "returncode": 1,
             "output": (
-                "SOASERIALS WARNING - zones_warning is 1: domain.tld (outside range "
-                "0:0) | zones_critical=0;~:;0 zones_warning=1;0;~:"
+                b"SOASERIALS WARNING - zones_warning is 1: domain.tld (outside range "
+                b"0:0) | zones_critical=0;~:;0 zones_errored=0;~:;0 zones_warning=1;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain.tld."),
-            ],
         },
     ),
     (
         # Crit with a higher threshold
-        {
-            "port": SRV_PORT_1,
-            "zone_soa_mappings": {
-                "domain.tld": 1,
-            },
-        },
-        {
-            "port": SRV_PORT_2,
-            "zone_soa_mappings": {
-                "domain.tld": 101,
-            },
-        },
-        [
-            "--zone",
-            "domain.tld",
-            # Crit if number of bad zones is outside -inf:inf which is
-            # impossible,  thus only WARN
-            "--critical=99",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, (("domain.tld", 1),)),
+        (SRV_PORT_2, (("domain.tld", 101),)),
+        ("--zone", "domain.tld", "--critical=99"),
         {
             "returncode": 2,
             "output": (
-                "SOASERIALS CRITICAL - zones_critical is 1: domain.tld (outside range "
-                "0:0) | zones_critical=1;~:;0 zones_warning=0;0;~:"
+                b"SOASERIALS CRITICAL - zones_critical is 1: domain.tld (outside range "
+                b"0:0) | zones_critical=1;~:;0 zones_errored=0;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain.tld."),
-            ],
         },
     ),
     (
         # OK with zones from file
-        {
-            "port": SRV_PORT_1,
-        },
-        {
-            "port": SRV_PORT_2,
-        },
-        [
-            "--zones-file",
-            TMP_ZONES_FILE,
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+        (SRV_PORT_1, None),
+        (SRV_PORT_2, None),
+        ("--zones-file", TMP_ZONES_FILE),
         {
             "returncode": 0,
             "output": (
-                "SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
-                "zones_warning=0;0;~:"
+                b"SOASERIALS OK - zones_critical is 0 | zones_critical=0;~:;0 "
+                b"zones_errored=0;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain1.tld."),
+                    ("udp", "domain2.tld."),
+                }
             ),
-            "request_history": [
-                ("udp", "domain1.tld."),
-                ("udp", "domain2.tld."),
-            ],
         },
     ),
     (
         # OK with default thresholds over TCP
+        (SRV_PORT_1, None),
+        (SRV_PORT_2, None),
+        ("--zone", "domain.tld", "--proto=tcp"),
         {
-            "port": SRV_PORT_1,
+            "returncode": 0,
+            "output": b"OK",
+            "request_history": frozenset(
+                {
+                    ("tcp", "domain.tld."),
+                }
+            ),
         },
+    ),
+    (
+        # CRIT when one zone errors (answerless response) but the other
+        # still produces data: partial results, not an aborted check
+        (SRV_PORT_1, (("broken.tld", None),)),
+        (SRV_PORT_2, (("broken.tld", None),)),
+        ("--zone", "domain.tld", "--zone", "broken.tld"),
         {
-            "port": SRV_PORT_2,
+            "returncode": 2,
+            "output": (
+                b"SOASERIALS CRITICAL - zones_errored is 1: broken.tld (outside range "
+                b"0:0) | zones_critical=0;~:;0 zones_errored=1;~:;0 zones_warning=0;0;~:"
+            ),
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                    ("udp", "broken.tld."),
+                }
+            ),
         },
-        [
-            "--zone",
-            "domain.tld",
-            "--proto=tcp",
-            f"localhost:{SRV_PORT_1}",
-            f"localhost:{SRV_PORT_2}",
-        ],
+    ),
+    (
+        # UNKNOWN when every zone errors: there is no data at all to report
+        (SRV_PORT_1, (("domain.tld", None),)),
+        (SRV_PORT_2, (("domain.tld", None),)),
+        ("--zone", "domain.tld"),
         {
-            "returncode": 0,
-            "output": "OK",
-            "request_history": [
-                ("tcp", "domain.tld."),
-            ],
+            "returncode": 3,
+            "output": b"SOASERIALS UNKNOWN - SOA lookups failed for every zone",
+            "request_history": frozenset(
+                {
+                    ("udp", "domain.tld."),
+                }
+            ),
         },
     ),
 ]
@@ -335,22 +334,25 @@ test_cases: list = [
     # ],
 )
 def test_end_to_end(
-    capsys: pytest.CaptureFixture,
+    capsysbinary: pytest.CaptureFixture,
     dummy_server_1: list,
     dummy_server_2: list,
-    args: list,
+    args: tuple,
     expected: dict,
 ) -> None:
     """Test"""
     with pytest.raises(SystemExit) as excinfo:
-        program.main(argv=args)
+        program.main(argv=[*args, *COMMON_ARGS])
     assert excinfo.value.code == expected["returncode"]
-    output = capsys.readouterr().out.rstrip("\n")  # type:ignore
+    # The expected outputs are pre-encoded bytes, so the captured stream can
+    # be compared as-is without a decode pass
+    output = capsysbinary.readouterr().out  # type:ignore
     logging.debug(output)
     assert expected["output"] in output
-    for request in expected["request_history"]:
-        assert request in dummy_server_1
-        assert request in dummy_server_2
+    # Snapshot each history once and compare hashed sets, rather than a
+    # linear scan per expected request
+    assert expected["request_history"] <= set(dummy_server_1)
+    assert expected["request_history"] <= set(dummy_server_2)
 
 
 # pylint: enable=unused-argument